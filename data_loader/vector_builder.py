@@ -8,10 +8,14 @@ line for Cloudflare Vectorize bulk insert.
 Design
 ------
 - Config: loads env + paths (12‑factor friendly)
-- CSVProcessor: loads/cleans rows, builds text, prepares metadata
-- CloudflareAIClient: batches embedding calls (<=100/texts per request)
-- VectorRecord: dataclass holding id/values/metadata
-- NDJSONWriter: serialises records with allow_nan=False
+- CSVProcessor: loads/cleans rows, then builds ids, text and metadata in one pass
+- CloudflareAIClient: concurrent batched embedding calls (<=100 texts per request)
+  over a pooled keep-alive session with retry/backoff on 429/5xx (shared by insert)
+- EmbeddingCache: on-disk fp16 vectors keyed by document hash, tagged with the
+  model (a file from another model is discarded), so unchanged rows skip the API
+  on re-runs
+- VectorRecord: dataclass holding id/values (numpy row)/metadata
+- NDJSONWriter: serialises records with orjson (strict JSON, NaN -> null) in bytes mode
 - Pipeline: orchestration + CLI
 
 Usage
@@ -20,30 +24,38 @@ python vector_builder.py \
   --csv ./courses.csv \
   --out ./vectors_to_upload.ndjson \
   --index csuf-courses \
+  --workers 8 \
   --env ../.dev.vars
 
 Insert after build
 python vector_builder.py --csv ./courses.csv --out ./vectors_to_upload.ndjson \
   --index csuf-courses --insert --env ../.dev.vars
+
+Reuse embeddings of unchanged rows across runs
+python vector_builder.py --csv ./courses.csv --out ./vectors_to_upload.ndjson \
+  --index csuf-courses --cache ./embeddings_cache.npz --env ../.dev.vars
 """
 from __future__ import annotations
 
 import argparse
 import dataclasses
-import json
+import hashlib
 import logging
-import math
 import os
 import re
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 
 import numpy as np
+import orjson
 import pandas as pd
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 LOG = logging.getLogger("vectorize_builder")
 logging.basicConfig(
@@ -53,66 +65,49 @@ logging.basicConfig(
 
 DEFAULT_MODEL = "@cf/baai/bge-base-en-v1.5"  # 768 dims
 MAX_BATCH = 100  # Cloudflare model accepts up to 100 texts in one call
+DEFAULT_WORKERS = 8  # concurrent embedding requests in flight
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 FORBIDDEN_KEY_CHARS = re.compile(r"[.\"$]")
-ID_SAFE = re.compile(r"[^a-zA-Z0-9_\-.]")
+ID_DIGEST_SIZE = 8  # bytes -> 16 hex chars per record id
+CONTROL_WS = r"[\n\r\t]"
+TEXT_DTYPE = "string[pyarrow]"  # Arrow-backed strings: C++ kernels for concat/strip/replace
+JSON_OPTS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE
+WRITE_BUFFER = 1 << 20
+WRITE_BATCH = 1024  # NDJSON lines encoded per write() call
 
 def chunked(seq: Sequence[Any], size: int) -> Iterable[Sequence[Any]]:
     for i in range(0, len(seq), size):
         yield seq[i : i + size]
 
-def sanitize_text(text: Any) -> Any:
-    """Collapse whitespace + ensure UTF-8; do not alter quotes."""
-    if not isinstance(text, str):
-        return text
-    text = text.replace("\n", " ").replace("\r", " ").replace("\t", " ")
-    return text.encode("utf-8", "ignore").decode("utf-8")
-
-def normalize_metadata_keys(d: Dict[str, Any]) -> Dict[str, Any]:
-    out = {}
-    for k, v in d.items():
-        k2 = FORBIDDEN_KEY_CHARS.sub("_", k)
-        if k2.startswith("$"):
-            k2 = "_" + k2[1:]
-        out[k2 or "_"] = v
-    return out
-
-def to_native(v: Any) -> Any:
-    """Convert numpy scalars so json.dumps works, keep None for missing."""
-    if isinstance(v, (np.integer,)):
-        return int(v)
-    if isinstance(v, (np.floating,)):
-        f = float(v)
-        return None if (isinstance(f, float) and not math.isfinite(f)) else f
-    return v
-
-def json_safe(obj: Any) -> Any:
-    """Recursively turn NaN/Infinity into None to satisfy strict JSON."""
-    if isinstance(obj, dict):
-        return {k: json_safe(v) for k, v in obj.items()}
-    if isinstance(obj, list):
-        return [json_safe(v) for v in obj]
-    if isinstance(obj, float) and not math.isfinite(obj):
-        return None
-    return obj
-
-def stable_id(row: pd.Series, idx: int) -> str:
-    base = f"{row.get('Course','unknown')}_{row.get('First Last','unknown')}_{idx}"
-    return ID_SAFE.sub("_", base)
+def make_session(pool_size: int) -> requests.Session:
+    """Session with pooled keep-alive connections and exponential backoff on 429/5xx."""
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False,  # surface the final response via raise_for_status()
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+def normalize_metadata_key(key: Any) -> str:
+    """Make a column label safe as a Vectorize metadata key."""
+    return FORBIDDEN_KEY_CHARS.sub("_", str(key)) or "_"
 
 
 @dataclasses.dataclass
 class VectorRecord:
     id: str
-    values: List[float]
+    values: np.ndarray
     metadata: Dict[str, Any]
 
-    def to_json_line(self) -> str:
-        payload = {
-            "id": self.id,
-            "values": [float(x) for x in self.values],
-            "metadata": json_safe(self.metadata),
-        }
-        return json.dumps(payload, ensure_ascii=False, allow_nan=False)
+    def to_json_line(self) -> bytes:
+        # Metadata is already JSON-safe (see CSVProcessor.load); orjson encodes the
+        # numpy row straight from its buffer and would null any stray NaN/Infinity
+        return orjson.dumps({"id": self.id, "values": self.values, "metadata": self.metadata}, option=JSON_OPTS)
 
 
 class Config:
@@ -132,35 +127,107 @@ class Config:
 
 
 class CloudflareAIClient:
-    def __init__(self, cfg: Config, model: str = DEFAULT_MODEL, batch_size: int = MAX_BATCH, sleep_s: float = 0.0):
+    def __init__(self, cfg: Config, model: str = DEFAULT_MODEL, batch_size: int = MAX_BATCH, sleep_s: float = 0.0, workers: int = DEFAULT_WORKERS):
         self.cfg = cfg
         self.model = model
         self.batch_size = max(1, min(batch_size, MAX_BATCH))
         self.sleep_s = max(0.0, sleep_s)
+        self.workers = max(1, workers)
         self.url = f"{cfg.api_base}/ai/run/{model}"
         self.headers = {"Authorization": f"Bearer {cfg.api_token}"}
-
-    def embed(self, texts: List[str]) -> List[List[float]]:
-        LOG.info("Embedding %d texts in batches of %d", len(texts), self.batch_size)
-        out: List[List[float]] = []
-        for chunk in chunked(texts, self.batch_size):
-            resp = requests.post(self.url, headers=self.headers, json={"text": list(chunk)}, timeout=120)
-            try:
-                resp.raise_for_status()
-                data = resp.json()
-                vecs = data["result"]["data"]
-                if len(vecs) != len(chunk):
-                    raise RuntimeError(f"Embedding count mismatch: expected {len(chunk)} got {len(vecs)}")
-                out.extend(vecs)
-            finally:
+        self.session = make_session(self.workers)
+        self.session.headers.update(self.headers)
+
+    def _embed_batch(self, chunk: Sequence[str]) -> List[List[float]]:
+        resp = self.session.post(self.url, json={"text": list(chunk)}, timeout=120)
+        resp.raise_for_status()
+        data = resp.json()
+        vecs = data["result"]["data"]
+        if len(vecs) != len(chunk):
+            raise RuntimeError(f"Embedding count mismatch: expected {len(chunk)} got {len(vecs)}")
+        return vecs
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        LOG.info("Embedding %d texts in batches of %d (%d workers)", len(texts), self.batch_size, self.workers)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = []
+            for chunk in chunked(texts, self.batch_size):
+                futures.append(pool.submit(self._embed_batch, chunk))
                 if self.sleep_s:
                     time.sleep(self.sleep_s)
-        if not out:
+            # Fill in submission order so vectors stay aligned with texts; fp16 keeps
+            # the (N, dim) matrix ~20x smaller than lists of Python floats
+            out: Optional[np.ndarray] = None
+            start = 0
+            try:
+                for fut in futures:
+                    vecs = fut.result()
+                    if out is None and vecs:
+                        out = np.empty((len(texts), len(vecs[0])), dtype=np.float16)
+                    out[start : start + len(vecs)] = vecs
+                    start += len(vecs)
+            except BaseException:
+                # One failed batch fails the run: drop queued batches instead of
+                # sending (and retrying) every remaining request before raising
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+        if out is None:
             raise RuntimeError("No embeddings returned")
-        LOG.info("Got embeddings; dimension=%d", len(out[0]))
+        LOG.info("Got embeddings; dimension=%d", out.shape[1])
         return out
 
 
+class EmbeddingCache:
+    def __init__(self, path: Path, model: str):
+        self.path = Path(path)
+        self.model = model
+        self.vectors: Dict[str, np.ndarray] = {}
+        if self.path.exists():
+            with np.load(self.path) as data:
+                cached_model = str(data["model"]) if "model" in data.files else None
+                if cached_model != model or data["vectors"].ndim != 2:
+                    # Another model's vectors (often another dimension) can't be mixed
+                    # with this run's; start over and overwrite the file on save
+                    LOG.info("Ignoring embedding cache %s built for model %s", self.path, cached_model)
+                else:
+                    self.vectors = dict(zip(data["keys"].tolist(), data["vectors"]))
+                    LOG.info("Loaded %d cached embeddings from %s", len(self.vectors), self.path)
+
+    def key(self, text: str) -> str:
+        # The file is already per-model; the model in the key is a second guard
+        return hashlib.blake2b(f"{self.model}\0{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.vectors
+
+    def get_many(self, keys: Sequence[str]) -> np.ndarray:
+        return np.stack([self.vectors[k] for k in keys])
+
+    def put_many(self, keys: Sequence[str], vectors: np.ndarray) -> None:
+        # BGE vectors are L2-normalised, so fp16 storage keeps cosine similarity intact
+        for key, vec in zip(keys, vectors.astype(np.float16, copy=False)):
+            self.vectors[key] = vec
+
+    def save(self) -> None:
+        if not self.vectors:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        try:
+            with tmp.open("wb") as f:
+                np.savez_compressed(
+                    f,
+                    model=np.array(self.model),
+                    keys=np.array(list(self.vectors)),
+                    vectors=np.stack(list(self.vectors.values())),
+                )
+            os.replace(tmp, self.path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        LOG.info("Saved %d cached embeddings to %s", len(self.vectors), self.path)
+
+
 class CSVProcessor:
     def __init__(self, csv_path: Path):
         self.csv_path = Path(csv_path)
@@ -168,9 +235,10 @@ class CSVProcessor:
             raise SystemExit(f"CSV not found: {self.csv_path}")
 
     def load(self) -> pd.DataFrame:
-        df = pd.read_csv(self.csv_path)
-        # Drop unnamed columns often created by CSV editors
-        df = df.loc[:, ~df.columns.str.contains(r"^Unnamed")]
+        # pyarrow parses in multithreaded C++; dtypes stay numpy-backed for the masks below
+        df = pd.read_csv(self.csv_path, engine="pyarrow")
+        # Drop unnamed columns often created by CSV editors (pyarrow leaves them blank)
+        df = df.loc[:, ~df.columns.str.contains(r"^(?:Unnamed|$)")]
         # Clean a few expected string columns if present
         for col in [
             "First Last",
@@ -182,34 +250,57 @@ class CSVProcessor:
             "Graduate Eligibility",
         ]:
             if col in df.columns:
-                df[col] = df[col].fillna("").map(sanitize_text)
-        return df
+                # Flatten newlines/tabs; text is already valid UTF-8 once decoded; quotes untouched.
+                # On Arrow strings this is one C++ regex kernel per column.
+                df[col] = df[col].fillna("").astype(TEXT_DTYPE).str.replace(CONTROL_WS, " ", regex=True)
+        # Mask NaN/Infinity once per float column instead of per metadata value
+        float_cols = df.select_dtypes(include=[np.floating]).columns
+        if len(float_cols):
+            df[float_cols] = df[float_cols].mask(~np.isfinite(df[float_cols]))
+        # Normalise labels once so every metadata record comes out with safe keys
+        return df.rename(columns=normalize_metadata_key)
 
     @staticmethod
-    def build_document(row: pd.Series) -> str:
-        g = row.get
-        parts: List[str] = []
-        if g("Course Name") or g("Course"):
-            parts.append(f"Course: {g('Course Name','').strip()} ({g('Course','').strip()}).")
-        if g("First Last"):
-            parts.append(f"Taught by Professor {g('First Last','').strip()}.")
-        if g("Description"):
-            parts.append(f"Description: {g('Description','').strip()}.")
-        if g("Prerequisite"):
-            parts.append(f"Prerequisites: {g('Prerequisite','').strip()}.")
-        if pd.notna(g("Avg GPA", np.nan)):
-            parts.append(f"Average GPA: {g('Avg GPA')}.")
-        if pd.notna(g("Difficulty", np.nan)):
-            parts.append(f"Difficulty: {g('Difficulty')}/5.")
-        return " ".join(p for p in parts if p and p != " ")
-
-    @staticmethod
-    def prepare_metadata(row: pd.Series) -> Dict[str, Any]:
-        # Convert pandas NaN -> None, numpy scalars -> native, and normalise keys
-        d = row.where(pd.notna(row), None).to_dict()
-        d = {str(k): to_native(v) for k, v in d.items()}
-        d = normalize_metadata_keys(d)
-        return d
+    def prepare_all(df: pd.DataFrame) -> Tuple[List[str], List[str], List[Dict[str, Any]]]:
+        """Ids, embedding documents and metadata records from one set of column ops."""
+        def text(col: str, missing: str = "") -> pd.Series:
+            if col not in df.columns:
+                return pd.Series(missing, index=df.index, dtype=TEXT_DTYPE)
+            return df[col].fillna("").astype(TEXT_DTYPE)
+
+        def number(col: str) -> pd.Series:
+            if col not in df.columns:
+                return pd.Series(np.nan, index=df.index)
+            return df[col]
+
+        # Stable ids: blake2b over `<Course>|<First Last>|<row>`; always [0-9a-f]{16},
+        # so no allow-list sanitising is needed for Vectorize
+        ids = [
+            hashlib.blake2b(f"{course}|{prof}|{idx}".encode("utf-8"), digest_size=ID_DIGEST_SIZE).hexdigest()
+            for course, prof, idx in zip(text("Course", "unknown"), text("First Last", "unknown"), df.index)
+        ]
+
+        name, code, prof = text("Course Name"), text("Course"), text("First Last")
+        desc, prereq = text("Description"), text("Prerequisite")
+        gpa, difficulty = number("Avg GPA"), number("Difficulty")
+        # Each part carries its own trailing separator so empty parts vanish on concat
+        parts = [
+            ("Course: " + name.str.strip() + " (" + code.str.strip() + "). ").where(name.ne("") | code.ne(""), ""),
+            ("Taught by Professor " + prof.str.strip() + ". ").where(prof.ne(""), ""),
+            ("Description: " + desc.str.strip() + ". ").where(desc.ne(""), ""),
+            ("Prerequisites: " + prereq.str.strip() + ". ").where(prereq.ne(""), ""),
+            ("Average GPA: " + gpa.astype(str) + ". ").where(gpa.notna(), ""),
+            ("Difficulty: " + difficulty.astype(str) + "/5. ").where(difficulty.notna(), ""),
+        ]
+        documents = parts[0].str.cat(parts[1:]).str.rstrip(" ").tolist()
+
+        # load() already masked non-finite floats and normalised keys; NaN -> None here.
+        # Zipping rows of the object array skips to_dict's per-cell native boxing: the
+        # astype(object) cast already produced Python ints/floats/strs.
+        cells = df.astype(object).where(df.notna(), None)
+        columns = cells.columns.tolist()
+        metadata = [dict(zip(columns, row)) for row in cells.to_numpy().tolist()]
+        return ids, documents, metadata
 
 
 class NDJSONWriter:
@@ -217,40 +308,56 @@ class NDJSONWriter:
         self.out_path = Path(out_path)
         self.out_path.parent.mkdir(parents=True, exist_ok=True)
 
-    def write(self, records: Iterable[VectorRecord]) -> int:
+    def write(self, records: Sequence[VectorRecord]) -> int:
         count = 0
-        with self.out_path.open("w", encoding="utf-8") as f:
-            for rec in records:
-                f.write(rec.to_json_line() + "\n")
-                count += 1
+        with self.out_path.open("wb", buffering=WRITE_BUFFER) as f:
+            # One write per block of lines; blocks keep peak memory bounded on large corpora
+            for block in chunked(records, WRITE_BATCH):
+                f.write(b"".join([rec.to_json_line() for rec in block]))
+                count += len(block)
         LOG.info("Wrote %d vectors to %s", count, self.out_path)
         return count
 
 
 class Pipeline:
-    def __init__(self, cfg: Config, csv_path: Path, out_path: Path, index: str, model: str = DEFAULT_MODEL, batch_size: int = MAX_BATCH, sleep_s: float = 0.0):
+    def __init__(self, cfg: Config, csv_path: Path, out_path: Path, index: str, model: str = DEFAULT_MODEL, batch_size: int = MAX_BATCH, sleep_s: float = 0.0, workers: int = DEFAULT_WORKERS, cache_path: Optional[Path] = None):
         self.cfg = cfg
         self.csv = CSVProcessor(csv_path)
         self.out = NDJSONWriter(out_path)
         self.idx_name = index
-        self.client = CloudflareAIClient(cfg, model=model, batch_size=batch_size, sleep_s=sleep_s)
+        self.client = CloudflareAIClient(cfg, model=model, batch_size=batch_size, sleep_s=sleep_s, workers=workers)
+        self.cache = EmbeddingCache(cache_path, model) if cache_path else None
+
+    def embed_documents(self, documents: List[str]) -> np.ndarray:
+        if self.cache is None:
+            return self.client.embed(documents)
+        keys = [self.cache.key(doc) for doc in documents]
+        misses = [i for i, key in enumerate(keys) if key not in self.cache]
+        hits = [i for i, key in enumerate(keys) if key in self.cache]
+        LOG.info("Embedding cache: %d hits, %d misses", len(hits), len(misses))
+        if not misses:
+            return self.cache.get_many(keys)
+        fresh = self.client.embed([documents[i] for i in misses])
+        out = np.empty((len(documents), fresh.shape[1]), dtype=np.float16)
+        out[misses] = fresh
+        if hits:
+            out[hits] = self.cache.get_many([keys[i] for i in hits])
+        self.cache.put_many([keys[i] for i in misses], fresh)
+        self.cache.save()
+        return out
 
     def build(self) -> Tuple[int, int]:
         df = self.csv.load()
         LOG.info("Loaded %d rows from %s", len(df), self.csv.csv_path)
-        documents = [self.csv.build_document(row) for _, row in df.iterrows()]
-        embeddings = self.client.embed(documents)
-        dim = len(embeddings[0])
+        ids, documents, metadata = self.csv.prepare_all(df)
+        embeddings = self.embed_documents(documents)
+        dim = embeddings.shape[1]
         LOG.info("Embedding dimension detected: %d", dim)
 
-        records: List[VectorRecord] = []
-        for (df_idx, row), emb in zip(df.iterrows(), embeddings):
-            rec = VectorRecord(
-                id=stable_id(row, df_idx),
-                values=[float(x) for x in emb],
-                metadata=self.csv.prepare_metadata(row),
-            )
-            records.append(rec)
+        # Widen fp16 storage to fp32 in one cast so the index receives the exact stored
+        # values; records hold row views of the result
+        values = embeddings.astype(np.float32)
+        records = [VectorRecord(id=i, values=v, metadata=m) for i, v, m in zip(ids, values, metadata)]
         written = self.out.write(records)
         return written, dim
 
@@ -258,12 +365,13 @@ class Pipeline:
         # Insert the out_path NDJSON as raw body with application/x-ndjson
         url = f"{self.cfg.api_base}/vectorize/v2/indexes/{self.idx_name}/insert"
         LOG.info("Inserting NDJSON into index '%s' via %s", self.idx_name, url)
-        data = Path(self.out.out_path).read_bytes()
-        headers = {
-            "Authorization": f"Bearer {self.cfg.api_token}",
-            "Content-Type": "application/x-ndjson",
-        }
-        r = requests.post(url, headers=headers, data=data, timeout=300)
+        # Reuse the embedding client's session: its connection to api.cloudflare.com
+        # is already warm, and it carries the auth header and 429/5xx backoff
+        headers = {"Content-Type": "application/x-ndjson"}
+        # Stream the file as the body (Content-Length from its size) instead of
+        # buffering it; urllib3 rewinds the handle if a retry is needed
+        with Path(self.out.out_path).open("rb") as data:
+            r = self.client.session.post(url, headers=headers, data=data, timeout=300)
         r.raise_for_status()
         resp = r.json()
         mut = (resp.get("result") or {}).get("mutationId")
@@ -280,6 +388,8 @@ def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
     p.add_argument("--model", default=DEFAULT_MODEL, help="Embedding model to use")
     p.add_argument("--batch-size", type=int, default=MAX_BATCH, help="Batch size (<=100)")
     p.add_argument("--sleep", type=float, default=0.0, help="Sleep seconds between batches")
+    p.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Concurrent embedding requests")
+    p.add_argument("--cache", type=Path, default=None, help="Embedding cache (.npz); unchanged rows skip the API")
     p.add_argument("--insert", action="store_true", help="Insert NDJSON after building")
     return p.parse_args(argv)
 
@@ -295,6 +405,8 @@ def main(argv: Optional[Sequence[str]] = None) -> None:
         model=args.model,
         batch_size=args.batch_size,
         sleep_s=args.sleep,
+        workers=args.workers,
+        cache_path=args.cache,
     )
     written, dim = pipe.build()
     LOG.info("Build complete: %d records, dimension=%d", written, dim)
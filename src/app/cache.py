@@ -0,0 +1,35 @@
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+import hashlib
+import time
+
+class LRUCache:
+    """Small in-memory LRU with per-entry expiry; lives as long as the isolate that imported it"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        # key -> (expires_at, value)
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            # Expired: a warm isolate must not outlive the TTL (e.g. across a reindex)
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, value: Any, ttl_secs: float) -> None:
+        self._entries[key] = (time.time() + ttl_secs, value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+def question_key(question: str, top_k: int, embed_model: str, prefix: str = "q") -> str:
+    # Case/whitespace-insensitive so trivially different phrasings share an entry
+    normalized = " ".join(question.lower().split())
+    digest = hashlib.blake2b(f"{embed_model}\0{normalized}".encode("utf-8"), digest_size=16).hexdigest()
+    return f"{prefix}:{top_k}:{digest}"
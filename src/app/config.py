@@ -2,7 +2,7 @@ from dataclasses import dataclass
 from typing import Any
 from .utils import env_get
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Config:
     """Application configuration with defaults"""
     embed_model: str = "@cf/baai/bge-base-en-v1.5"
@@ -11,14 +11,18 @@ class Config:
     temperature: float = 0.2
     max_tokens: int = 350
     app_version: str = "dev"
+    qcache_ttl: int = 3600
 
     @classmethod
     def from_env(cls, env: Any) -> "Config":
+        # With slots the class attributes are descriptors, so read defaults off an instance
+        defaults = cls()
         return cls(
-            embed_model=env_get(env, "CF_EMBED_MODEL", cls.embed_model),
-            chat_model=env_get(env, "CF_CHAT_MODEL", cls.chat_model),
-            topk=int(env_get(env, "CF_TOPK", cls.topk)),
-            temperature=float(env_get(env, "GEN_TEMPERATURE", cls.temperature)),
-            max_tokens=int(env_get(env, "GEN_MAX_TOKENS", cls.max_tokens)),
-            app_version=env_get(env, "APP_VERSION", cls.app_version),
+            embed_model=env_get(env, "CF_EMBED_MODEL", defaults.embed_model),
+            chat_model=env_get(env, "CF_CHAT_MODEL", defaults.chat_model),
+            topk=int(env_get(env, "CF_TOPK", defaults.topk)),
+            temperature=float(env_get(env, "GEN_TEMPERATURE", defaults.temperature)),
+            max_tokens=int(env_get(env, "GEN_MAX_TOKENS", defaults.max_tokens)),
+            app_version=env_get(env, "APP_VERSION", defaults.app_version),
+            qcache_ttl=int(env_get(env, "QCACHE_TTL", defaults.qcache_ttl)),
         )
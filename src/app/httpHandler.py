@@ -1,24 +1,57 @@
 from typing import Any, Dict, Optional
 from workers import Response
-import json
+
+# orjson encodes in native code; fall back to the stdlib where the runtime lacks it
+try:
+    import orjson
+
+    def dumps(data: Any) -> str:
+        return orjson.dumps(data).decode()
+except ImportError:
+    import json
+
+    def dumps(data: Any) -> str:
+        return json.dumps(data)
 
 # Custom headers for frontend 
 EXPOSED_HEADERS = (
     "X-RateLimit-Limit, X-RateLimit-Remaining, X-RateLimit-Reset, Retry-After, X-Version, X-Service"
 )
 
+# Header templates built once; per-response dicts only copy them when something varies
+_CORS_BASE = {
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+    "Access-Control-Max-Age": "86400",
+    "Access-Control-Expose-Headers": EXPOSED_HEADERS,
+}
+_CORS_WILDCARD = {"Access-Control-Allow-Origin": "*", **_CORS_BASE}
+_JSON_HEADERS_BASE = {"content-type": "application/json", **_CORS_BASE}
+_JSON_HEADERS_WILDCARD = {"content-type": "application/json", **_CORS_WILDCARD}
+
 def get_cors_headers(origin: str | None = None) -> Dict[str, str]:
-    headers = {
-        "Access-Control-Allow-Origin": origin or "*",
-        "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type",
-        "Access-Control-Max-Age": "86400",
-        "Access-Control-Expose-Headers": EXPOSED_HEADERS,
-    }
+    if not origin or origin == "*":
+        return dict(_CORS_WILDCARD)
     # Help caches/CDNs keep separate variants per Origin when not using '*'
+    return {"Access-Control-Allow-Origin": origin, **_CORS_BASE, "Vary": "Origin"}
+
+def json_body_response(
+    body: str,
+    status: int = 200,
+    origin: str | None = None,
+    extra_headers: Optional[Dict[str, str]] = None,
+) -> Response:
+    """Response for an already-serialized JSON body (e.g. a precomputed constant)"""
     if origin and origin != "*":
-        headers["Vary"] = "Origin"
-    return headers
+        headers = {**_JSON_HEADERS_BASE, "Access-Control-Allow-Origin": origin, "Vary": "Origin"}
+    elif extra_headers:
+        headers = dict(_JSON_HEADERS_WILDCARD)
+    else:
+        # Response copies headers into its own Headers object, so the template stays intact
+        return Response(body, status=status, headers=_JSON_HEADERS_WILDCARD)
+    if extra_headers:
+        headers.update(extra_headers)
+    return Response(body, status=status, headers=headers)
 
 def json_response(
     data: Any,
@@ -26,11 +59,7 @@ def json_response(
     origin: str | None = None,
     extra_headers: Optional[Dict[str, str]] = None,
 ) -> Response:
-    headers = {"content-type": "application/json"}
-    headers.update(get_cors_headers(origin))
-    if extra_headers:
-        headers.update(extra_headers)
-    return Response(json.dumps(data), status=status, headers=headers)
+    return json_body_response(dumps(data), status=status, origin=origin, extra_headers=extra_headers)
 
 def json_error(
     message: str,
@@ -1,101 +1,231 @@
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import json
 import re
+from js import Object
 from pyodide.ffi import to_js
+from .cache import LRUCache, question_key
 from .config import Config
 from .utils import jsobj, to_py
 
+# Citation cleanup for generated answers, compiled once per isolate. "(ref: [n])"
+# goes first: removing "[n]" first would leave "(ref: )" behind
+_RE_REF_PAREN = re.compile(r"\(\s*ref:\s*\[\s*\d+\s*\]\s*\)", re.IGNORECASE)
+_RE_BRACKET_NUM = re.compile(r"\[\s*\d+\s*\]")
+_RE_MULTISPACE = re.compile(r"\s{2,}")
+
+# Static prompt text around the per-request context and question
+_PROMPT_PREFIX = (
+    "You are a helpful CSU Fullerton course assistant.\n"
+    "Answer concisely using ONLY the provided context. "
+    "If the answer isn't in the context, say you don't know.\n\n"
+    "# Context\n"
+)
+_PROMPT_STYLE = (
+    "# Style\n- Keep it under 6 sentences.\n"
+    "- Do not include references, IDs, or bracketed numbers in the answer.\n"
+)
+
+_NO_METADATA: Dict[str, Any] = {}
+
+class EmbeddingError(RuntimeError):
+    """Workers AI returned no usable embedding"""
+
+class VectorSearchError(RuntimeError):
+    """Vectorize query failed or returned an unexpected shape"""
+
+class AnswerGenerationError(RuntimeError):
+    """Chat model returned an empty answer"""
+
+# JS objects holding the fixed chat-model inputs (temperature, max_tokens),
+# marshalled once per config instead of on every generate_answer call
+_CHAT_INPUT_BASES: Dict[Config, Any] = {}
+
+# Answers and retrieval results per normalized question, shared by every request
+# in this isolate (two entries per question, hence the size)
+_RESULT_CACHE = LRUCache(max_entries=512)
+
 class RAGPipeline:
-    def __init__(self, config: Config, ai_binding: Any, courses_binding: Any):
+    def __init__(self, config: Config, ai_binding: Any, courses_binding: Any,
+                 kv_cache: Any = None, ctx: Any = None):
         self.config = config
         self.ai = ai_binding
         self.courses = courses_binding
+        self.kv_cache = kv_cache
+        self.ctx = ctx
 
     def strip_references(self, text: str) -> str:
-        text = re.sub(r"\[\s*\d+\s*\]", "", text)
-        text = re.sub(r"\(\s*ref:\s*\[\s*\d+\s*\]\s*\)", "", text, flags=re.IGNORECASE)
-        text = re.sub(r"\s{2,}", " ", text).strip()
-        return text
+        text = _RE_REF_PAREN.sub("", text)
+        text = _RE_BRACKET_NUM.sub("", text)
+        return _RE_MULTISPACE.sub(" ", text).strip()
 
-    async def embed_text(self, text: str) -> List[float]:
+    async def embed_text(self, text: str) -> Any:
+        # The vector stays a JS array: it only goes back across to Vectorize, so
+        # converting its 768 floats to Python and back would be wasted work
         resp = await self.ai.run(self.config.embed_model, jsobj({"text": text}))
-        result = to_py(resp)
-        data = result.get("data")
+        data = getattr(resp, "data", None)
         if not data:
-            raise RuntimeError(f"Embedding failed: Empty embedding result: {result}")
+            raise EmbeddingError(f"Empty embedding result: {to_py(resp)}")
         return data[0]
 
-    async def search_vectors(self, vector: List[float], top_k: int) -> List[Dict[str, Any]]:
+    async def embed_texts(self, texts: List[str]) -> List[Any]:
+        # The embedding model takes a list, so N questions cost one AI call
+        resp = await self.ai.run(self.config.embed_model, jsobj({"text": texts}))
+        data = getattr(resp, "data", None)
+        if not data or len(data) != len(texts):
+            raise EmbeddingError(f"expected {len(texts)} embeddings: {to_py(resp)}")
+        return list(data)
+
+    async def search_vectors(self, vector: Any, top_k: int) -> List[Dict[str, Any]]:
+        # to_js unwraps a JS array from embed_text as-is and converts a Python list
         vector_js = to_js(vector)
         options_js = jsobj({"topK": int(top_k), "returnValues": False, "returnMetadata": "all"})
         try:
             resp = await self.courses.query(vector_js, options_js)
             result = to_py(resp)
         except Exception as e:
-            raise RuntimeError(f"Vector search failed. New API: {e}")
+            raise VectorSearchError(f"New API: {e}") from e
         if not isinstance(result, dict):
-            raise RuntimeError(f"Vector search failed: expected dict, got {type(result).__name__}")
+            raise VectorSearchError(f"expected dict, got {type(result).__name__}")
         matches = result.get("matches")
         if not isinstance(matches, list):
             keys = list(result.keys())
-            raise RuntimeError(f"Vector search failed: expected 'matches' list, got {type(matches).__name__}; keys={keys}")
+            raise VectorSearchError(f"expected 'matches' list, got {type(matches).__name__}; keys={keys}")
+        return matches
+
+    def _answer_key(self, question: str, top_k: int) -> str:
+        # An answer also depends on the chat model and its sampling settings
+        cfg = self.config
+        models = f"{cfg.embed_model}\0{cfg.chat_model}\0{cfg.temperature}\0{cfg.max_tokens}"
+        return question_key(question, top_k, models, prefix="a")
+
+    async def _cache_get(self, key: str) -> Any:
+        value = _RESULT_CACHE.get(key)
+        if value is None and self.kv_cache:
+            # The cache is best-effort: a KV failure or bad entry is just a miss
+            try:
+                raw = to_py(await self.kv_cache.get(key))
+                value = json.loads(raw) if raw else None
+            except Exception:
+                return None
+            if value is not None:
+                _RESULT_CACHE.put(key, value, self.config.qcache_ttl)
+        return value
+
+    async def _cache_put(self, key: str, value: Any) -> None:
+        _RESULT_CACHE.put(key, value, self.config.qcache_ttl)
+        if self.kv_cache:
+            try:
+                put = self.kv_cache.put(key, json.dumps(value), jsobj({"expirationTtl": self.config.qcache_ttl}))
+                # Write back off the response path when the runtime lets us
+                if self.ctx is not None:
+                    self.ctx.waitUntil(put)
+                else:
+                    await put
+            except Exception:
+                # A failed write-back only costs a future cache hit
+                pass
+
+    async def retrieve(self, question: str, top_k: int) -> List[Dict[str, Any]]:
+        """Vector matches for a question, skipping embed + search on a cache hit"""
+        key = question_key(question, top_k, self.config.embed_model)
+        matches = await self._cache_get(key)
+        if matches is None:
+            vec = await self.embed_text(question)
+            matches = await self.search_vectors(vec, top_k)
+            await self._cache_put(key, matches)
         return matches
 
     def build_context(self, matches: List[Dict[str, Any]]) -> Tuple[str, List[Dict[str, Any]]]:
+        if not matches:
+            # Off-topic questions often retrieve nothing
+            return "No context.", []
         blocks, sources = [], []
         for match in matches:
-            md = match.get("metadata") or {}
-            course = md.get("Course Name") or md.get("Course") or ""
-            instructor = md.get("First Last") or ""
-            description = md.get("Description") or ""
-            prerequisite = md.get("Prerequisite") or ""
-            lines = [f"Course: {course}", f"Instructor: {instructor}"]
-            if description:
-                lines.append(f"Description: {description}")
-            if prerequisite:
-                lines.append(f"Prerequisites: {prerequisite}")
-            blocks.append("\n".join(lines))
+            md = match.get("metadata") or _NO_METADATA
+            # One lookup per field, shared by the context block and the source entry
+            code, name, instructor = md.get("Course"), md.get("Course Name"), md.get("First Last")
+            description, prerequisite = md.get("Description"), md.get("Prerequisite")
+            blocks.append(
+                f"Course: {name or code or ''}\nInstructor: {instructor or ''}"
+                + (f"\nDescription: {description}" if description else "")
+                + (f"\nPrerequisites: {prerequisite}" if prerequisite else "")
+            )
             sources.append({
                 "id": match.get("id"),
                 "score": round((match.get("score") or 0), 3),
-                "course": md.get("Course"),
-                "courseName": md.get("Course Name"),
-                "instructor": md.get("First Last"),
+                "course": code,
+                "courseName": name,
+                "instructor": instructor,
             })
-        context = "\n\n".join(blocks) if blocks else "No context."
-        return context, sources
+        return "\n\n".join(blocks), sources
 
     def make_prompt(self, question: str, context: str) -> str:
-        return (
-            "You are a helpful CSU Fullerton course assistant.\n"
-            "Answer concisely using ONLY the provided context. "
-            "If the answer isn't in the context, say you don't know.\n\n"
-            f"# Context\n{context}\n\n"
-            f"# Question\n{question}\n\n"
-            "# Style\n- Keep it under 6 sentences.\n"
-            "- Do not include references, IDs, or bracketed numbers in the answer.\n"
-        )
+        return f"{_PROMPT_PREFIX}{context}\n\n# Question\n{question}\n\n{_PROMPT_STYLE}"
 
     async def generate_answer(self, prompt: str) -> str:
-        inputs = jsobj({
-            "prompt": prompt,
-            "temperature": self.config.temperature,
-            "max_tokens": self.config.max_tokens
-        })
+        base = _CHAT_INPUT_BASES.get(self.config)
+        if base is None:
+            base = _CHAT_INPUT_BASES[self.config] = jsobj({
+                "temperature": self.config.temperature,
+                "max_tokens": self.config.max_tokens
+            })
+        # Only the prompt crosses into JS per call; assign copies the fixed fields in
+        inputs = Object.assign(jsobj({"prompt": prompt}), base)
         resp = await self.ai.run(self.config.chat_model, inputs)
         result = to_py(resp)
         answer = result.get("response") or (result.get("result") or {}).get("response") or ""
         answer = self.strip_references(answer)
         if not answer:
-            raise RuntimeError(f"Answer generation failed: Empty generation result: {result}")
+            raise AnswerGenerationError(f"Empty generation result: {result}")
         return answer
 
-    async def process_question(self, question: str, top_k: int | None = None) -> Dict[str, Any]:
-        if top_k is None:
-            top_k = self.config.topk
-        top_k = max(1, min(10, int(top_k)))
-        vec = await self.embed_text(question)
-        matches = await self.search_vectors(vec, top_k)
+    async def answer_from_matches(self, question: str, matches: List[Dict[str, Any]]) -> Dict[str, Any]:
         context, sources = self.build_context(matches)
         prompt = self.make_prompt(question, context)
         answer = await self.generate_answer(prompt)
         return {"answer": answer, "sources": sources}
+
+    def _clamp_top_k(self, top_k: int | None) -> int:
+        if top_k is None:
+            top_k = self.config.topk
+        return max(1, min(10, int(top_k)))
+
+    async def process_question(self, question: str, top_k: int | None = None) -> Dict[str, Any]:
+        top_k = self._clamp_top_k(top_k)
+        # A repeated question is answered from cache without any AI or Vectorize call
+        key = self._answer_key(question, top_k)
+        result = await self._cache_get(key)
+        if result is None:
+            matches = await self.retrieve(question, top_k)
+            result = await self.answer_from_matches(question, matches)
+            await self._cache_put(key, result)
+        return result
+
+    async def process_questions(self, questions: List[str], top_k: int | None = None) -> List[Dict[str, Any]]:
+        """Answer several questions with one embedding call and concurrent search/generation"""
+        top_k = self._clamp_top_k(top_k)
+        answer_keys = [self._answer_key(q, top_k) for q in questions]
+        results = list(await asyncio.gather(*[self._cache_get(key) for key in answer_keys]))
+        pending = [i for i, r in enumerate(results) if r is None]
+        if not pending:
+            return results
+
+        # Only unanswered questions need matches; of those, only misses are embedded
+        keys = [question_key(questions[i], top_k, self.config.embed_model) for i in pending]
+        matches = list(await asyncio.gather(*[self._cache_get(key) for key in keys]))
+        misses = [j for j, m in enumerate(matches) if m is None]
+        if misses:
+            vectors = await self.embed_texts([questions[pending[j]] for j in misses])
+            found = await asyncio.gather(*[self.search_vectors(vec, top_k) for vec in vectors])
+            for j, m in zip(misses, found):
+                matches[j] = m
+                await self._cache_put(keys[j], m)
+
+        answered = await asyncio.gather(*[
+            self.answer_from_matches(questions[i], m) for i, m in zip(pending, matches)
+        ])
+        for i, result in zip(pending, answered):
+            results[i] = result
+            await self._cache_put(answer_keys[i], result)
+        return results
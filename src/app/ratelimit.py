@@ -1,48 +1,64 @@
-import json
 import time
 from typing import Any, Tuple
+from urllib.parse import parse_qs, urlparse
+from pyodide.ffi import to_js
+from workers import DurableObject, Response
+from .utils import to_py
 
 def _now_s() -> int:
     return int(time.time())
 
-async def check_and_increment(ip: str, kv: Any, limit: int = 3, window_secs: int = 60
-) -> Tuple[bool, int, int]:
+class RateLimiter(DurableObject):
+    """Fixed-window counter for a single IP (one object per IP via idFromName)."""
+
+    async def fetch(self, request):
+        query = parse_qs(urlparse(str(request.url)).query)
+        limit = int(query.get("limit", ["3"])[0])
+        window_secs = int(query.get("window", ["60"])[0])
+        # A negative cost refunds units charged earlier in the window
+        cost = int(query.get("cost", ["1"])[0])
+
+        now = _now_s()
+        # Align windows to exact minute boundaries for predictable resets
+        window_start = now - (now % window_secs)
+        window_end = window_start + window_secs
+        reset = max(1, window_end - now)
+
+        # Input gates hold other events for this object while storage is awaited,
+        # so the read-modify-write below is atomic without blockConcurrencyWhile
+        storage = self.ctx.storage
+        state = to_py(await storage.get("state"))
+        count = state[1] if state and state[0] == window_start else 0
+
+        if cost > 0 and count + cost > limit:
+            # Not enough budget left in this window; charge nothing
+            return Response("", status=429, headers={
+                "X-RateLimit-Remaining": str(max(0, limit - count)),
+                "X-RateLimit-Reset": str(reset),
+            })
+
+        # Clamped so a refund landing in a fresh window can't leave credit behind
+        count = max(0, count + cost)
+        await storage.put("state", to_js([window_start, count]))
+        # Drop the counter once the window closes so idle IPs keep no storage
+        await storage.setAlarm(window_end * 1000)
+        return Response("", status=200, headers={
+            "X-RateLimit-Remaining": str(max(0, limit - count)),
+            "X-RateLimit-Reset": str(reset),
+        })
+
+    async def alarm(self):
+        await self.ctx.storage.deleteAll()
+
+async def check_and_increment(ip: str, limiter: Any, limit: int = 3, window_secs: int = 60,
+                              cost: int = 1) -> Tuple[bool, int, int]:
     # If can't identify IP, do not block
     if not ip:
         return True, limit, window_secs
 
-    now = _now_s()
-    # Align windows to exact minute boundaries for predictable resets
-    window_start = now - (now % window_secs)
-    window_end = window_start + window_secs
-    ttl = max(1, window_end - now)
-
-    key = f"rl:{ip}"
-    # Read current counter
-    raw = await kv.get(key)  
-    data = None
-    if raw:
-        # raw is a JS string bridged to Python; parse it
-        if hasattr(raw, "to_py"):
-            raw = raw.to_py()
-        data = json.loads(raw)
-
-    if not data or data.get("window_start") != window_start:
-        # New window
-        data = {"window_start": window_start, "count": 1}
-        await kv.put(key, json.dumps(data), {"expirationTtl": ttl})
-        remaining = max(0, limit - 1)
-        return True, remaining, ttl
-
-    # Same window; increment if under limit
-    count = int(data.get("count", 0))
-    if count >= limit:
-        # Already at limit
-        reset = max(1, window_end - now)
-        return False, 0, reset
-
-    data["count"] = count + 1
-    await kv.put(key, json.dumps(data), {"expirationTtl": ttl})
-    remaining = max(0, limit - data["count"])
-    reset = max(1, window_end - now)
-    return True, remaining, reset
+    # One Durable Object round-trip: the object counts and answers in headers
+    stub = limiter.get(limiter.idFromName(ip))
+    resp = await stub.fetch(f"https://rate-limiter/?limit={limit}&window={window_secs}&cost={cost}")
+    remaining = int(resp.headers.get("X-RateLimit-Remaining"))
+    reset = int(resp.headers.get("X-RateLimit-Reset"))
+    return resp.status != 429, remaining, reset
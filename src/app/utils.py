@@ -1,13 +1,17 @@
 from typing import Any, Dict
 import json
 from js import Object
-from pyodide.ffi import to_js, JsProxy
+from pyodide.ffi import to_js
 
 def jsobj(data: dict):
     return to_js(data, dict_converter=Object.fromEntries)
 
 def to_py(obj: Any) -> Any:
-    return obj.to_py() if isinstance(obj, JsProxy) else obj
+    # Only JS proxies carry to_py(); plain Python values pass through
+    try:
+        return obj.to_py()
+    except AttributeError:
+        return obj
 
 def env_get(env: Any, key: str, default: Any = None) -> Any:
     if env is None:
@@ -20,21 +24,26 @@ def env_get(env: Any, key: str, default: Any = None) -> Any:
     except Exception:
         return default
 
+def url_path(url: str) -> str:
+    # Slice the path straight out of an absolute URL; the router needs nothing else
+    start = url.find("/", url.find("://") + 3)
+    if start == -1:
+        return "/"
+    end = len(url)
+    for sep in "?#":
+        idx = url.find(sep, start)
+        if idx != -1 and idx < end:
+            end = idx
+    return url[start:end]
+
 async def parse_json_body(request) -> Dict[str, Any]:
+    # Read the stream once and parse once: a body can't be re-read after a failed
+    # request.json(), so the old text() fallback could never succeed anyway
+    text = await request.text()
     try:
-        body = await request.json()
-        body = to_py(body)
-        if isinstance(body, str):
-            body = json.loads(body)
-        if not isinstance(body, dict):
-            raise ValueError("JSON body must be an object")
-        return body
-    except Exception:
-        try:
-            text = await request.text()
-            body = json.loads(text or "")
-            if not isinstance(body, dict):
-                raise ValueError("JSON body must be an object")
-            return body
-        except Exception as e:
-            raise ValueError("Body must be JSON object") from e
+        body = json.loads(text or "")
+    except ValueError as e:
+        raise ValueError("Body must be JSON object") from e
+    if not isinstance(body, dict):
+        raise ValueError("Body must be JSON object")
+    return body
@@ -1,71 +1,157 @@
+import asyncio
+from typing import Any, Dict, Optional, Tuple
 from workers import Response, WorkerEntrypoint
-from urllib.parse import urlparse
 
 from app.config import Config
-from app.httpHandler import get_cors_headers, json_error, json_response
-from app.pipeline import RAGPipeline
-from app.utils import parse_json_body, env_get
-from app.ratelimit import check_and_increment
+from app.httpHandler import dumps, get_cors_headers, json_body_response, json_error, json_response
+from app.pipeline import AnswerGenerationError, EmbeddingError, RAGPipeline, VectorSearchError
+from app.utils import parse_json_body, env_get, url_path
+# Not unused: the RATE_LIMITER Durable Object binding looks the class up on this
+# module, so RateLimiter must stay imported (and listed in __all__)
+from app.ratelimit import RateLimiter, check_and_increment
+
+__all__ = ["Default", "RateLimiter"]
+
+# Per-IP budget: each question (not each request) costs one unit, since the
+# limit exists to cap Workers AI generations
+RATE_LIMIT = 3
+RATE_WINDOW_SECS = 60
+
+# Upper bound on questions answered by one batched /ask request; a larger batch
+# could never fit in one window's budget
+MAX_BATCH_QUESTIONS = RATE_LIMIT
+
+# Constant GET payloads, serialized once per isolate
+_ROOT_BODY = dumps({"message": "Hello Titan!"})
+_HEALTH_BODY = dumps({"OK": True})
+_VERSION_BODIES: Dict[str, str] = {}
+
+# Pipeline failure type -> (error label, status); anything else is a generic failure
+_ERR_MAP = {
+    EmbeddingError: ("Embedding failed", 502),
+    VectorSearchError: ("Vector search failed", 502),
+    AnswerGenerationError: ("Answer generation failed", 502),
+}
+
+# Rate-limit headers that never change; copied and filled in per request
+_RATE_HEADERS_TEMPLATE = {"X-RateLimit-Limit": str(RATE_LIMIT)}
 
 class Default(WorkerEntrypoint):
+    # Env vars are fixed for the isolate's lifetime, so parse them once
+    _config: Optional[Config] = None
+    # So are the bindings: (AI, COURSES, QCACHE, RATE_LIMITER), resolved on the first /ask
+    _bindings: Optional[Tuple[Any, Any, Any, Any]] = None
+
     async def fetch(self, request):
-        config = Config.from_env(self.env)
-        url = urlparse(str(request.url))
+        config = Default._config
+        if config is None:
+            config = Default._config = Config.from_env(self.env)
+        path = url_path(str(request.url))
         origin = request.headers.get("Origin")
+        method = request.method
 
-        if request.method == "OPTIONS":
-            return Response("", status=204, headers=get_cors_headers(origin))
-
-        if request.method == "GET":
-            if  url.path == "/":
-                return json_response({"message": "Hello Titan!"}, origin=origin,)
-            elif url.path == "/health":
-                return json_response({"OK": True}, origin=origin)
-            elif url.path == "/version":
-                return json_response({"version": config.app_version}, origin=origin)
+        # Exact (method, path) first, then the method's catch-all (path None)
+        handler = (self._ROUTES.get((method, path))
+                   or self._ROUTES.get((method, None))
+                   or Default._not_found)
+        return await handler(self, request, config, origin)
 
-        if request.method == "POST" and url.path == "/ask":
-            return await self._handle_rag_request(request, config, origin)
+    async def _options(self, request, config: Config, origin: str) -> Response:
+        return Response("", status=204, headers=get_cors_headers(origin))
 
+    async def _not_found(self, request, config: Config, origin: str) -> Response:
         return Response("Not Found", status=404)
 
+    async def _root(self, request, config: Config, origin: str) -> Response:
+        return json_body_response(_ROOT_BODY, origin=origin)
+
+    async def _health(self, request, config: Config, origin: str) -> Response:
+        return json_body_response(_HEALTH_BODY, origin=origin)
+
+    async def _version(self, request, config: Config, origin: str) -> Response:
+        body = _VERSION_BODIES.get(config.app_version)
+        if body is None:
+            body = _VERSION_BODIES[config.app_version] = dumps({"version": config.app_version})
+        return json_body_response(body, origin=origin)
+
+    async def _charge_rate_limit(self, ip: Optional[str], limiter: Any, origin: str, cost: int
+                                 ) -> Tuple[Dict[str, str], Optional[Response]]:
+        """Rate-limit headers for this request, plus a 429 response if the charge was refused"""
+        allowed, remaining, reset = await check_and_increment(
+            ip, limiter, limit=RATE_LIMIT, window_secs=RATE_WINDOW_SECS, cost=cost)
+        rate_headers = dict(_RATE_HEADERS_TEMPLATE)
+        rate_headers["X-RateLimit-Remaining"] = str(remaining)
+        rate_headers["X-RateLimit-Reset"] = str(reset)
+        if allowed:
+            return rate_headers, None
+        return rate_headers, self._rate_limited(rate_headers, origin)
+
+    def _rate_limited(self, rate_headers: Dict[str, str], origin: str) -> Response:
+        rate_headers["Retry-After"] = rate_headers["X-RateLimit-Reset"]
+        return json_error(
+            "Rate limit exceeded",
+            detail=f"{RATE_LIMIT} questions per minute allowed for this IP.",
+            status=429,
+            origin=origin,
+            extra_headers=rate_headers,
+        )
 
     async def _handle_rag_request(self, request, config: Config, origin: str) -> Response:
         rate_headers = {}
 
-        # --- Identify IP and get KV binding ---
-        ip = (request.headers.get("CF-Connecting-IP")
-              or (request.headers.get("X-Forwarded-For") or "").split(",")[0].strip()
-              or None)
-        kv = env_get(self.env, "KV_RATE")
-        
-        # --- Rate limit check BEFORE any heavy work ---
-        if kv:
-            allowed, remaining, reset = await check_and_increment(ip, kv, limit=3, window_secs=60)
-            rate_headers.update({
-                "X-RateLimit-Limit": "3",
-                "X-RateLimit-Remaining": str(remaining),
-                "X-RateLimit-Reset": str(reset),
-            })
-            if not allowed:
-                rate_headers["Retry-After"] = str(reset)
-                return json_error(
-                    "Rate limit exceeded",
-                    detail="3 requests per minute allowed for this IP.",
-                    status=429,
-                    origin=origin,
-                    extra_headers=rate_headers,
-                )
+        # --- Identify IP and get rate limiter binding ---
+        ip = request.headers.get("CF-Connecting-IP")
+        if not ip:
+            forwarded = request.headers.get("X-Forwarded-For")
+            ip = (forwarded.partition(",")[0].strip() or None) if forwarded else None
+        bindings = Default._bindings
+        if bindings is None:
+            bindings = Default._bindings = tuple(
+                env_get(self.env, name) for name in ("AI", "COURSES", "QCACHE", "RATE_LIMITER"))
+        ai_binding, courses_binding, kv_cache, limiter = bindings
+
+        # Read the body while the rate limiter round-trip is in flight
+        body_task = asyncio.create_task(parse_json_body(request))
+
+        # --- Rate limit check BEFORE any heavy work (charges the first question) ---
+        if limiter:
+            try:
+                rate_headers, limited = await self._charge_rate_limit(ip, limiter, origin, cost=1)
+            except BaseException:
+                # Don't leave the body read running unawaited behind a failed check
+                body_task.cancel()
+                raise
+            if limited:
+                body_task.cancel()
+                return limited
 
         # --- Parse and validate request body ---
         try:
-            body = await parse_json_body(request)
+            body = await body_task
         except ValueError as e:
             return json_error(str(e), status=400, origin=origin, extra_headers=rate_headers)
 
-        question = (body.get("question") or "").strip()
-        if not question:
-            return json_error("Missing 'question'", status=400, origin=origin, extra_headers=rate_headers)
+        questions = body.get("questions")
+        if questions is not None:
+            if (not isinstance(questions, list) or not 1 <= len(questions) <= MAX_BATCH_QUESTIONS
+                    or not all(isinstance(q, str) and q.strip() for q in questions)):
+                return json_error(
+                    "Invalid 'questions'",
+                    detail=f"Expected 1-{MAX_BATCH_QUESTIONS} non-empty strings.",
+                    status=400, origin=origin, extra_headers=rate_headers,
+                )
+            questions = [q.strip() for q in questions]
+            # The rest of the batch pays before any AI work starts
+            if limiter and len(questions) > 1:
+                rate_headers, limited = await self._charge_rate_limit(ip, limiter, origin, cost=len(questions) - 1)
+                if limited:
+                    # Refused whole: hand back the unit charged for the first question
+                    rate_headers, _ = await self._charge_rate_limit(ip, limiter, origin, cost=-1)
+                    return self._rate_limited(rate_headers, origin)
+        else:
+            question = (body.get("question") or "").strip()
+            if not question:
+                return json_error("Missing 'question'", status=400, origin=origin, extra_headers=rate_headers)
 
         try:
             top_k = int(body.get("topK") or config.topk)
@@ -73,25 +159,28 @@ class Default(WorkerEntrypoint):
         except Exception:
             return json_error("Invalid 'topK'", status=400, origin=origin, extra_headers=rate_headers)
 
-        ai_binding = env_get(self.env, "AI")
-        courses_binding = env_get(self.env, "COURSES")
         if not ai_binding:
             return json_error("AI binding missing", status=500, origin=origin, extra_headers=rate_headers)
         if not courses_binding:
             return json_error("COURSES binding missing", status=500, origin=origin, extra_headers=rate_headers)
 
         try:
-            pipeline = RAGPipeline(config, ai_binding, courses_binding)
-            result = await pipeline.process_question(question, top_k)
+            pipeline = RAGPipeline(config, ai_binding, courses_binding,
+                                   kv_cache=kv_cache, ctx=self.ctx)
+            if questions is not None:
+                result = {"results": await pipeline.process_questions(questions, top_k)}
+            else:
+                result = await pipeline.process_question(question, top_k)
             return json_response(result, origin=origin, extra_headers=rate_headers)
         except Exception as e:
-            msg = str(e)
-            if "Embedding failed" in msg:
-                message, status = "Embedding failed", 502
-            elif "Vector search failed" in msg:
-                message, status = "Vector search failed", 502
-            elif "Answer generation failed" in msg:
-                message, status = "Answer generation failed", 502
-            else:
-                message, status = "Pipeline failed", 502
-            return json_error(message, detail=msg, status=status, origin=origin, extra_headers=rate_headers)
+            message, status = _ERR_MAP.get(type(e), ("Pipeline failed", 502))
+            return json_error(message, detail=str(e), status=status, origin=origin, extra_headers=rate_headers)
+
+    # Every route in one table: a single hashed lookup instead of a method/path ladder
+    _ROUTES = {
+        ("GET", "/"): _root,
+        ("GET", "/health"): _health,
+        ("GET", "/version"): _version,
+        ("POST", "/ask"): _handle_rag_request,
+        ("OPTIONS", None): _options,
+    }